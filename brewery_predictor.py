@@ -8,16 +8,195 @@ from tkinter import messagebox
 from pandas import to_datetime
 from datetime import datetime
 from math import ceil
+from contextlib import contextmanager
+from random import random
+from multiprocessing import Process, Event
+from time import sleep, perf_counter
+import tempfile
+import shutil
 import csv
 import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl, so msvcrt is used instead
+    fcntl = None
+    import msvcrt
 
 
 SALES_FILEPATH = 'data/sales_data.json'
 TANKS_FILEPATH = 'data/tanks_status.json'
 BOTTLES_FILEPATH = 'data/bottle_quantities.json'
+VERSION_KEY = 'version'
+MAX_OPTIMISTIC_RETRIES = 5
+REPLACE_TIMEOUT = 5
+MIN_THROUGHPUT_FRACTION = 0.5
 APP = None
 
 
+@contextmanager
+def lock_json_file(filepath: str):
+    """Holds an exclusive advisory lock for one JSON file while in the block.
+
+    The lock is taken on a separate '.lock' file next to the JSON file, so
+    each data file (sales, tanks, bottles) has its own lock and the data file
+    itself can be atomically replaced while readers have it open. The lock
+    file is created with the data file's permissions and only ever opened for
+    reading, so every user who can save the data can also take its lock.
+
+    Arguments:
+    filepath: string - filepath of the JSON file to be locked
+    """
+    lock_filepath = filepath + '.lock'
+    try:
+        lock_descriptor = os.open(lock_filepath,
+                                  os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, lock_filepath)
+    except FileExistsError:
+        lock_descriptor = os.open(lock_filepath, os.O_RDONLY)
+    with os.fdopen(lock_descriptor, 'r') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_json(filepath: str) -> dict:
+    """Loads a JSON data file without taking its lock.
+
+    Writers always replace the whole file in one step, so a reader sees either
+    the old or the new document and never has to wait for a writer.
+
+    Arguments:
+    filepath: string - filepath of the JSON file to be read
+
+    Returns:
+    document: dict - the JSON data, including its version stamp
+    """
+    with open(filepath, 'r') as file:
+        return json.load(file)
+
+
+def replace_json_file(filepath: str, document: dict):
+    """Writes a JSON document to a temporary file that replaces the original.
+
+    The caller must hold the file's lock. Readers see either the whole old
+    document or the whole new one, never a partly written file. The original
+    file's permissions are kept, so other users of a shared data folder can
+    still read and write it.
+
+    Arguments:
+    filepath: string - filepath of the JSON file to be replaced
+    document: dict - the new JSON data
+
+    Raises a PermissionError if the file can't be replaced within
+    REPLACE_TIMEOUT seconds.
+    """
+    file_descriptor, temp_filepath = tempfile.mkstemp(
+        dir=os.path.dirname(filepath) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as file:
+            json.dump(document, file)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, temp_filepath)
+        else:
+            # mkstemp makes the file private, so give a new data file the
+            # mode any other newly created file would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_filepath, 0o666 & ~umask)
+        deadline = perf_counter() + REPLACE_TIMEOUT
+        while True:
+            try:
+                os.replace(temp_filepath, filepath)
+                break
+            except PermissionError:  # Windows: a reader has the file open
+                if perf_counter() > deadline:
+                    raise
+                sleep(0.01)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+
+def write_json(filepath: str, document: dict, expected_version: int) -> bool:
+    """Saves a JSON document if nobody else has saved it since it was read.
+
+    The file's lock is taken and the version stamp on disk is compared with
+    the version the document was read at. If they match, the document is
+    given the next version and saved. If they don't, another writer got there
+    first and nothing is saved.
+
+    Arguments:
+    filepath: string - filepath of the JSON file to be written
+    document: dict - the new JSON data
+    expected_version: int - the version stamp the document was read at
+
+    Returns:
+    bool - whether the document was saved (False = the data read was stale)
+    """
+    with lock_json_file(filepath):
+        if read_json(filepath).get(VERSION_KEY, 0) != expected_version:
+            return False
+        document[VERSION_KEY] = expected_version + 1
+        replace_json_file(filepath, document)
+    return True
+
+
+def update_json(filepath: str, change) -> bool:
+    """Applies a change to a JSON file without losing other writers' work.
+
+    The document is read, changed and saved with write_json. If another writer
+    saved the file in the meantime, the change is applied again to the newer
+    document, so both writers' changes are kept. After MAX_OPTIMISTIC_RETRIES
+    failed attempts the change is made while holding the file's lock, so a
+    busy file can't stop a writer from ever finishing.
+
+    Arguments:
+    filepath: string - filepath of the JSON file to be changed
+    change: function - takes the document and changes it in place, returning
+                       False if the change shouldn't be saved
+
+    Returns:
+    bool - whether the change was saved
+    """
+    for attempt in range(MAX_OPTIMISTIC_RETRIES):
+        document = read_json(filepath)
+        version = document.get(VERSION_KEY, 0)
+        if change(document) is False:
+            return False
+        if write_json(filepath, document, version):
+            return True
+        # Back off for a random time so retrying writers don't collide again
+        sleep(random() * 0.001 * 2 ** attempt)
+
+    with lock_json_file(filepath):
+        document = read_json(filepath)
+        if change(document) is False:
+            return False
+        document[VERSION_KEY] = document.get(VERSION_KEY, 0) + 1
+        replace_json_file(filepath, document)
+    return True
+
+
 def test() -> bool:
     """This function runs tests to ensure that the program will run smoothly.
 
@@ -44,26 +223,162 @@ def test() -> bool:
     return True
 
 
+def stress_test_writer(filepaths: tuple, tank_name: str, no_changes: int):
+    """Makes changes to the data as one of the writers in stress_test.
+
+    This runs in its own process, so the data filepaths are passed in and set
+    here rather than inherited from the process that started it.
+
+    Arguments:
+    filepaths: tuple - the sales, tanks and bottles filepaths to be changed
+    tank_name: string - the tank to change, or None to add bottles instead
+    no_changes: int - how many changes to make
+    """
+    global SALES_FILEPATH, TANKS_FILEPATH, BOTTLES_FILEPATH
+    SALES_FILEPATH, TANKS_FILEPATH, BOTTLES_FILEPATH = filepaths
+    for i in range(no_changes):
+        if tank_name is None:
+            append_bottles(True, "Organic Pilsner", 1)
+        else:
+            alter_tanks_data(tank_name, "Fermenting", "Organic Pilsner",
+                             i % 800)
+
+
+def stress_test_reader(filepaths: tuple, finished: Event):
+    """Keeps loading the data files in its own process during stress_test.
+
+    A file that can't be loaded raises a ValueError, which ends the process
+    with a non-zero exit code.
+
+    Arguments:
+    filepaths: tuple - the sales, tanks and bottles filepaths to be read
+    finished: Event - set when the reader should stop
+    """
+    while not finished.is_set():
+        for filepath in filepaths:
+            read_json(filepath)
+
+
+def run_stress_writers(filepaths: tuple, tank_names: list,
+                       no_changes: int) -> tuple:
+    """Runs stress_test writers in separate processes at the same time.
+
+    Arguments:
+    filepaths: tuple - the sales, tanks and bottles filepaths to be changed
+    tank_names: list - the tank each writer changes (None = adds bottles)
+    no_changes: int - how many changes each writer makes
+
+    Returns:
+    (succeeded, changes_per_second): tuple[bool, float] - whether every writer
+                                     finished without an error and how many
+                                     changes were made each second
+    """
+    writers = [Process(target=stress_test_writer,
+                       args=(filepaths, tank_name, no_changes))
+               for tank_name in tank_names]
+    start_time = perf_counter()
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    changes_per_second = (len(writers) * no_changes /
+                          (perf_counter() - start_time))
+    return (all(writer.exitcode == 0 for writer in writers),
+            changes_per_second)
+
+
+def stress_test(no_writers: int = 8, no_changes: int = 25) -> tuple:
+    """Checks that many people changing the data at once don't lose changes.
+
+    Copies of the reset files are made in a temporary directory, and a reader
+    keeps loading them the whole time. One writer first adds bottles on its own
+    to find how fast a single writer is. Then half of the writers add one
+    bottle at a time with append_bottles and the other half change tanks with
+    alter_tanks_data, all at once. Each writer and the reader run in their own
+    process, like separate copies of the program. Every bottle added must be in
+    the final total, every tank change must have moved the tanks file on by one
+    version, the files must keep their permissions and their lock files must
+    have the same permissions, and the writers together must manage at least
+    MIN_THROUGHPUT_FRACTION of the single writer's changes per second.
+
+    Arguments:
+    no_writers: int - how many writers change the data at the same time
+    no_changes: int - how many changes each of those writers makes
+
+    Returns:
+    (passed, changes_per_second): tuple[bool, float] - whether the checks
+                                  passed (True = passed) and how many changes
+                                  per second the writers made together
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filepaths = (shutil.copy('data/reset/sales_data.json', temp_dir),
+                     shutil.copy('data/reset/tanks_status.json', temp_dir),
+                     shutil.copy('data/reset/bottle_quantities.json',
+                                 temp_dir))
+        tanks_filepath, bottles_filepath = filepaths[1:]
+        for filepath in filepaths:
+            os.chmod(filepath, 0o664)
+        start_modes = [os.stat(filepath).st_mode for filepath in filepaths]
+        start_bottles = int(read_json(bottles_filepath)["Organic Pilsner"])
+        start_version = read_json(tanks_filepath).get(VERSION_KEY, 0)
+        bottle_writers = no_writers // 2
+        tank_writers = no_writers - bottle_writers
+        finished = Event()
+        reader = Process(target=stress_test_reader,
+                         args=(filepaths, finished))
+        reader.start()
+
+        # The single writer makes as many changes as all the writers together
+        single_succeeded, single_writer_rate = run_stress_writers(
+            filepaths, [None], no_writers * no_changes)
+        tank_names = ([None] * bottle_writers +
+                      ["ABCDEF"[i % 6] for i in range(tank_writers)])
+        succeeded, changes_per_second = run_stress_writers(
+            filepaths, tank_names, no_changes)
+        finished.set()
+        reader.join()
+
+        end_bottles = int(read_json(bottles_filepath)["Organic Pilsner"])
+        end_version = read_json(tanks_filepath)[VERSION_KEY]
+        end_modes = [os.stat(filepath).st_mode for filepath in filepaths]
+        lock_modes = [os.stat(filepath + '.lock').st_mode
+                      for filepath in filepaths[1:]]
+        passed = (end_bottles == (start_bottles +
+                                  (no_writers + bottle_writers) * no_changes)
+                  and end_version == start_version + tank_writers * no_changes
+                  and end_modes == start_modes
+                  and lock_modes == start_modes[1:]
+                  and reader.exitcode == 0
+                  and single_succeeded and succeeded
+                  and (changes_per_second >=
+                       MIN_THROUGHPUT_FRACTION * single_writer_rate))
+        return passed, changes_per_second
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 def reset_system_files():
     """Resets all JSON data files by replacing them with the original files."""
     if messagebox.askyesno("Warning", "Are you sure you want to reset all "
                                       "data?"):
         try:
-            # Reset sales data
-            with open('data/reset/sales_data.json', 'r') as file:
-                reset_json = json.load(file)
-            with open(SALES_FILEPATH, 'w+') as file:
-                json.dump(reset_json, file)
-            # Reset bottle quantities
-            with open('data/reset/bottle_quantities.json', 'r') as file:
-                reset_json = json.load(file)
-            with open(BOTTLES_FILEPATH, 'w+') as file:
-                json.dump(reset_json, file)
-            # Reset tank status data
-            with open('data/reset/tanks_status.json', 'r') as file:
-                reset_json = json.load(file)
-            with open(TANKS_FILEPATH, 'w+') as file:
-                json.dump(reset_json, file)
+            # Reset sales data, bottle quantities and tank status data
+            for reset_filepath, filepath in (
+                    ('data/reset/sales_data.json', SALES_FILEPATH),
+                    ('data/reset/bottle_quantities.json', BOTTLES_FILEPATH),
+                    ('data/reset/tanks_status.json', TANKS_FILEPATH)):
+                reset_json = read_json(reset_filepath)
+                reset_json.pop(VERSION_KEY, None)
+                with lock_json_file(filepath):
+                    # Keep counting versions on from the current file so a
+                    # writer that read the data before the reset can't save
+                    try:
+                        version = read_json(filepath).get(VERSION_KEY, 0)
+                    except (OSError, ValueError):
+                        version = 0
+                    reset_json[VERSION_KEY] = version + 1
+                    replace_json_file(filepath, reset_json)
             # Update displays
             update_bottle_quantities_display()
             update_tanks_status_display()
@@ -87,8 +402,7 @@ def update_predicted_demand() -> dict:
                                         beer sold during each week of the year
     """
     try:
-        with open(SALES_FILEPATH, 'r') as file:
-            sales_json = json.load(file)
+        sales_json = read_json(SALES_FILEPATH)
     except OSError:
         return {}
     new_predicted_demand = {}
@@ -121,15 +435,14 @@ def amend_sales_data(is_test: bool, filename: str):
     The function iterates through the csv entries and adds each one into the
     Previous Sales JSON. The information added includes the quantity of
     bottles, the week the order was required, the type of beer and the year of
-    order.
+    order. The csv is read first, so if someone else changes the sales data
+    while it is being saved, the orders can be added again to their version.
 
     Arguments:
     is_test: boolean - if the function is being tested (True = it is)
     filename: string - filepath of the csv to be accessed.
     """
-    with open(SALES_FILEPATH, 'r') as file:
-        sales_json = json.load(file)
-
+    orders = []
     with open(filename, 'r') as csvfile:
         try:
             csvreader = csv.reader(csvfile)
@@ -151,26 +464,9 @@ def amend_sales_data(is_test: bool, filename: str):
 
                 beer_name = row[3]
                 quantity = row[5]
-                # Found out the index in the JSON of the year the order is from
-                year_index = -1
-                no_entries = len(sales_json[week])
-                if no_entries != 0:
-                    for i in range(0, no_entries):
-                        if sales_json[week][i]["year"] == str(order_date.year):
-                            year_index = i
-                            break
-                # Adds data to JSON
-                if year_index == -1:
-                    new_entry = {"year": str(order_date.year),
-                                 "Organic Red Helles": 0, "Organic Pilsner": 0,
-                                 "Organic Dunkel": 0, beer_name: quantity}
-                    sales_json[week].append(new_entry)
-                else:
-                    current_value = int(
-                        sales_json[week][year_index][beer_name])
-                    sales_json[week][year_index][beer_name] = str(
-                        current_value +
-                        int(quantity))
+                int(quantity)  # Checks the quantity is a whole number
+                orders.append([week, str(order_date.year), beer_name,
+                               quantity])
         except UnicodeDecodeError:
             messagebox.showerror("File Error", "The file selected is not a csv"
                                                " file or spreadsheet.")
@@ -178,10 +474,35 @@ def amend_sales_data(is_test: bool, filename: str):
             messagebox.showerror("File Data Error", "Some invalid data was "
                                                     "found in the csv file. " +
                                  str(row) + "Please fix and try again.")
-    if not is_test:
+
+    def add_orders(sales_json: dict) -> bool:
+        for week, year, beer_name, quantity in orders:
+            # Found out the index in the JSON of the year the order is from
+            year_index = -1
+            no_entries = len(sales_json[week])
+            if no_entries != 0:
+                for i in range(0, no_entries):
+                    if sales_json[week][i]["year"] == year:
+                        year_index = i
+                        break
+            # Adds data to JSON
+            if year_index == -1:
+                new_entry = {"year": year,
+                             "Organic Red Helles": 0, "Organic Pilsner": 0,
+                             "Organic Dunkel": 0, beer_name: quantity}
+                sales_json[week].append(new_entry)
+            else:
+                current_value = int(sales_json[week][year_index][beer_name])
+                sales_json[week][year_index][beer_name] = str(
+                    current_value +
+                    int(quantity))
+        return True
+
+    if is_test:
+        add_orders(read_json(SALES_FILEPATH))
+    elif orders:
         # Saves new data into the file
-        with open(SALES_FILEPATH, 'w') as file:
-            json.dump(sales_json, file)
+        update_json(SALES_FILEPATH, add_orders)
 
 
 def update_tanks_status_display():
@@ -190,8 +511,9 @@ def update_tanks_status_display():
     Opens and reads the Tank JSON and iterates through each tank, adding it's
     values into a string. This string is then used as the display.
     """
-    with open(TANKS_FILEPATH, 'r') as file:
-        tanks_json = json.load(file)
+    if APP is None:  # No GUI to update, e.g. during stress_test
+        return
+    tanks_json = read_json(TANKS_FILEPATH)
     tanks = tanks_json["tanks"]
     display_string = "CURRENT TANK STATUS: \n"
 
@@ -219,33 +541,32 @@ def alter_tanks_data(name: str, new_status: str, beer: str, new_volume: int):
     new_status: string - the status that the tank now has: Idle/Fermenting/
                             Finished Fermenting/Conditioning
     """
-    with open(TANKS_FILEPATH, 'r') as file:
-        tanks_json = json.load(file)
-    tanks = tanks_json["tanks"]
+    reason = None
 
-    # Validation of inputs
-    is_valid = True
-    volume_possible = False
-    for tank in tanks:
-        if tank["name"] == name:
-            if int(new_volume) <= int(tank["capacity"]):
-                volume_possible = True
-    if not volume_possible:
-        reason = "The volume entered is larger than the selected tank's capacity."
-        is_valid = False
-    elif name == "R" and new_status == "Conditioning":
-        reason = "Tank R can only be used for fermenting."
-        is_valid = False
-    elif ((name == "G" or name == "H") and
-          (new_status == "Fermenting" or new_status == "Finished Fermenting")):
-        reason = "Tanks G and H can only be used for conditioning."
-        is_valid = False
-
-    # Change tank's data or report error with data inputted
-    if not is_valid:
-        messagebox.showerror("INPUT ERROR",
-                             "Some values entered are impossible." + reason)
-    else:
+    def change_tank(tanks_json: dict) -> bool:
+        nonlocal reason
+        tanks = tanks_json["tanks"]
+
+        # Validation of inputs
+        volume_possible = False
+        for tank in tanks:
+            if tank["name"] == name:
+                if int(new_volume) <= int(tank["capacity"]):
+                    volume_possible = True
+        if not volume_possible:
+            reason = ("The volume entered is larger than the selected "
+                      "tank's capacity.")
+            return False
+        elif name == "R" and new_status == "Conditioning":
+            reason = "Tank R can only be used for fermenting."
+            return False
+        elif ((name == "G" or name == "H") and
+              (new_status == "Fermenting" or
+               new_status == "Finished Fermenting")):
+            reason = "Tanks G and H can only be used for conditioning."
+            return False
+
+        # Change tank's data
         for tank in tanks:
             if tank["name"] == name:
                 tank["status"] = new_status
@@ -256,9 +577,12 @@ def alter_tanks_data(name: str, new_status: str, beer: str, new_volume: int):
                         tank["date"] = str(datetime.today())
                     else:
                         tank["date"] = "N/A"
-    # Write these changes to the file
-    with open(TANKS_FILEPATH, 'w') as file:
-        json.dump(tanks_json, file)
+        return True
+
+    # Write these changes to the file or report error with data inputted
+    if not update_json(TANKS_FILEPATH, change_tank):
+        messagebox.showerror("INPUT ERROR",
+                             "Some values entered are impossible." + reason)
     update_tanks_status_display()
 
 
@@ -277,23 +601,23 @@ def append_bottles(add: bool, name: str, no_bottles: int):
 
     Returns an error if a negative value of bottles is given.
     """
-    with open(BOTTLES_FILEPATH, 'r') as file:
-        bottles_json = json.load(file)
-    if add:
-        bottles_json[name] = str(int(bottles_json[name]) + no_bottles)
-    else:
-        new_value = int(bottles_json[name]) - no_bottles
-        # Checks if subtraction would result in a negative quantity
-        if new_value < 0:
-            messagebox.showerror("Negative Quantity Error",
-                                 "The amount of bottles you would like to "
-                                 "remove would result in a negative "
-                                 "quantity. Please enter a new amount.")
-            return
+    def change_bottles(bottles_json: dict) -> bool:
+        if add:
+            bottles_json[name] = str(int(bottles_json[name]) + no_bottles)
         else:
+            new_value = int(bottles_json[name]) - no_bottles
+            # Checks if subtraction would result in a negative quantity
+            if new_value < 0:
+                return False
             bottles_json[name] = str(new_value)
-    with open(BOTTLES_FILEPATH, 'w') as file:
-        json.dump(bottles_json, file)
+        return True
+
+    if not update_json(BOTTLES_FILEPATH, change_bottles):
+        messagebox.showerror("Negative Quantity Error",
+                             "The amount of bottles you would like to "
+                             "remove would result in a negative "
+                             "quantity. Please enter a new amount.")
+        return
     update_bottle_quantities_display()
     return
 
@@ -301,8 +625,9 @@ def append_bottles(add: bool, name: str, no_bottles: int):
 def update_bottle_quantities_display():
     """Reads the bottle quantity JSON data and sets the display to these values
     """
-    with open(BOTTLES_FILEPATH, 'r') as file:
-        bottles_json = json.load(file)
+    if APP is None:  # No GUI to update, e.g. during stress_test
+        return
+    bottles_json = read_json(BOTTLES_FILEPATH)
     display_string = ''.join(
         ["Organic Pilsner : ", bottles_json["Organic Pilsner"],
          "\nOrganic Red Helles : ", bottles_json["Organic Red Helles"],
@@ -360,8 +685,7 @@ def calculate_beer_levels(tanks: dict) -> dict:
                    "Organic Dunkel": [0, 0, 0]}
 
     # Getting current amount of bottled beer (in litres)
-    with open(BOTTLES_FILEPATH, 'r') as file:
-        bottles_json = json.load(file)
+    bottles_json = read_json(BOTTLES_FILEPATH)
     beer_levels["Organic Pilsner"][0] = int(
         bottles_json["Organic Pilsner"]) / 2
     beer_levels["Organic Red Helles"][0] = (int(bottles_json["Organic Red Helles"])
@@ -448,8 +772,7 @@ def get_recommendations():
     each tank.
     These recommendations are joined together and displayed on the GUI.
     """
-    with open(TANKS_FILEPATH, 'r') as file:
-        tanks_json = json.load(file)
+    tanks_json = read_json(TANKS_FILEPATH)
     tanks = tanks_json["tanks"]
     display_string = []
     idle_tanks = sort_tanks(tanks, "Idle")